@@ -2,11 +2,25 @@ from flask import Flask, request, render_template, send_file, jsonify
 import csv
 import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import os
+import hashlib
+import logging
+import re
+import tempfile
+import threading
+import contextvars
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional
-import json
+from functools import lru_cache
+from collections import deque
+from itertools import chain, islice
+from types import MappingProxyType
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+import orjson
 
 # Load environment variables from .env file if it exists
 try:
@@ -15,38 +29,231 @@ try:
 except ImportError:
     pass  # python-dotenv is optional
 
+try:
+    import redis
+except ImportError:
+    redis = None  # redis is optional, responses are only cached when it is available
+
 app = Flask(__name__)
 
+# Per-request and progress messages are logged at DEBUG/INFO; production runs at WARNING
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'WARNING').upper()
+
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
 # Companies House API configuration
 API_BASE_URL = "https://api.company-information.service.gov.uk"
 API_KEY = os.getenv('COMPANIES_HOUSE_API_KEY', '')
 
 if not API_KEY:
-    print("WARNING: COMPANIES_HOUSE_API_KEY environment variable not set!")
-    print("Please set it before running the application.")
+    logger.warning("COMPANIES_HOUSE_API_KEY environment variable not set! "
+                   "Please set it before running the application.")
+
+# Address fields in the order they appear in a formatted address
+ADDRESS_FIELDS = ('address_line_1', 'address_line_2', 'locality', 'region', 'postal_code', 'country')
 
 # Rate limiting: 600 requests per 5 minutes
 RATE_LIMIT_REQUESTS = 600
 RATE_LIMIT_WINDOW = 300  # 5 minutes in seconds
-request_times = []
+# Burst allowance of the token bucket. The refill rate is reduced by the same amount so that
+# no 5-minute window can ever see more than RATE_LIMIT_REQUESTS calls (burst + rate * window).
+RATE_LIMIT_BURST = 60
+# Each Gunicorn worker process has its own token bucket, so the budget is split between them
+# (see gunicorn.conf.py; the development server runs a single process)
+WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
 
+# Attempts per API call when rate limited (429) or on server errors, with exponential backoff
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1  # seconds, doubled after each attempt
 
-def check_rate_limit():
-    """Check if we're within rate limits and wait if necessary"""
-    global request_times
-    now = time.time()
+# Results per advanced search request (the API maximum) so large searches need few pages
+ADVANCED_SEARCH_PAGE_SIZE = 5000
+
+# Keys the search endpoints use for the total number of results (advanced search reports 'hits')
+TOTAL_RESULTS_KEYS = ('hits', 'total_results', 'total_count', 'total_items')
+
+# Approximate size of each chunk of CSV text yielded by generate_csv
+CSV_CHUNK_SIZE = 64 * 1024
+
+# Searches matching more companies than this only fetch directors when the export is confirmed
+LARGE_OFFICER_EXPORT = 1000
+
+# Number of companies whose officers are fetched concurrently during an export
+OFFICER_FETCH_WORKERS = max(1, int(os.getenv('OFFICER_FETCH_WORKERS', '16')))
+# Number of companies whose officer lookups may be queued ahead of the CSV writer
+OFFICER_PREFETCH = 2 * OFFICER_FETCH_WORKERS
+# Number of additional officer pages fetched concurrently for a single company
+OFFICER_PAGE_WORKERS = 8
+
+# Background CSV exports: job state and finished files live in EXPORT_DIR so that
+# any worker process on the host can report progress and serve the download
+EXPORT_DIR = os.getenv('EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'companies_house_exports'))
+EXPORT_WORKERS = 2
+EXPORT_JOB_TTL = 3600  # finished exports can be downloaded for 1 hour
+EXPORT_JOB_ORPHAN_TTL = 86400  # queued/running jobs left behind by a restart are removed after a day
+EXPORT_JOB_ENDED = ('finished', 'failed', 'confirmation_required')
+
+os.makedirs(EXPORT_DIR, exist_ok=True)
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
+
+# Shared HTTP session so TCP/TLS connections to the API are kept alive and reused across calls.
+# Every call goes to the same host, so one connection pool is enough; it is sized for the
+# officer fetches of all concurrent exports so connections are not dropped after each use.
+api_session = requests.Session()
+api_session.auth = (API_KEY, '')
+api_session.headers.update({'Accept': 'application/json'})
+api_session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=EXPORT_WORKERS * OFFICER_FETCH_WORKERS,
+    # Only connection failures are retried here; HTTP error statuses are retried by
+    # make_api_request so that every attempt is paced by the rate limiter
+    max_retries=Retry(
+        total=3,
+        connect=3,
+        read=3,
+        status=0,
+        backoff_factor=0.5
+    )
+))
+
+# Response cache (Redis): officers change rarely, search results are kept briefly
+REDIS_URL = os.getenv('REDIS_URL', '')
+CACHE_TTL_OFFICERS = 3600  # 1 hour
+CACHE_TTL_SEARCH = 300  # 5 minutes
+CACHE_TTL_NOT_FOUND = 2  # 404s are only cached long enough to absorb bursts of duplicate lookups
+# Responses are kept this long after they go stale. Entries with an ETag are revalidated with
+# If-None-Match (a 304 reply lets us reuse the cached body without downloading it again), and any
+# entry is served as last-known-good data if Companies House is unavailable
+CACHE_TTL_STALE = 86400  # 24 hours
+
+cache = redis.Redis.from_url(REDIS_URL) if redis and REDIS_URL else None
+cache_stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stale': 0}
+cache_stats_lock = threading.Lock()
+
+# In-process cache of complete officer lists by company number, so repeat exports and
+# retries skip officer pagination even without Redis
+OFFICERS_CACHE_TTL = 3600  # 1 hour
+OFFICERS_CACHE_MAXSIZE = 8192
+officers_cache = {}
+officers_cache_lock = threading.Lock()
+
+# Export job being run by the current thread, so stale data can be flagged on that job only.
+# Officer fetches run in other threads, so they are submitted with a copy of the caller's context
+current_export_job = contextvars.ContextVar('current_export_job', default=None)
+# URLs of failed requests (answered with stale cached data, or with nothing), collected for
+# callers that must not keep that data as fresh or need to know that data is missing
+failed_requests = contextvars.ContextVar('failed_requests', default=None)
+
+
+class TokenBucket:
+    """Token bucket rate limiter: refills continuously at `rate` tokens per second up to `capacity`"""
+    __slots__ = ('tokens', 'last_refill', 'rate', 'capacity', 'lock')
     
-    # Remove requests older than the window
-    request_times = [t for t in request_times if now - t < RATE_LIMIT_WINDOW]
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
     
-    if len(request_times) >= RATE_LIMIT_REQUESTS:
-        # Wait until the oldest request expires
-        wait_time = RATE_LIMIT_WINDOW - (now - request_times[0]) + 1
-        print(f"Rate limit reached. Waiting {wait_time:.1f} seconds...")
-        time.sleep(wait_time)
-        request_times = [t for t in request_times if time.time() - t < RATE_LIMIT_WINDOW]
+    def consume(self):
+        """Take one token, sleeping until one is available if the bucket is empty"""
+        # Only the bookkeeping happens under the lock. The token is reserved straight away; a
+        # negative balance means earlier callers are already waiting, so each caller sleeps
+        # for its own place in the queue without blocking the others.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate
+        
+        if wait_time > 0:
+            logger.debug("Rate limit reached. Waiting %.1f seconds...", wait_time)
+            time.sleep(wait_time)
     
-    request_times.append(time.time())
+    def pause(self, seconds: float):
+        """Hold back every caller for at least `seconds`, e.g. when the API answers 429"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Callers already queued for longer than this keep their place
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+rate_limiter = TokenBucket(
+    (RATE_LIMIT_REQUESTS - RATE_LIMIT_BURST) / RATE_LIMIT_WINDOW / WEB_CONCURRENCY,
+    RATE_LIMIT_BURST / WEB_CONCURRENCY
+)
+
+
+def check_rate_limit():
+    """Check if we're within rate limits and wait if necessary"""
+    rate_limiter.consume()
+
+
+def cache_key(endpoint: str, params: Optional[Dict], method: str, json_data: Optional[Dict]) -> str:
+    """Build a stable cache key for an API request"""
+    raw = b''.join((
+        method.encode('utf-8'),
+        endpoint.encode('utf-8'),
+        orjson.dumps(params, option=orjson.OPT_SORT_KEYS),
+        orjson.dumps(json_data, option=orjson.OPT_SORT_KEYS)
+    ))
+    return 'ch:' + hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def count_cache(stat: str):
+    """Increment one of the cache counters reported by /health"""
+    with cache_stats_lock:
+        cache_stats[stat] += 1
+
+
+def cache_get(key: str) -> Optional[Dict]:
+    """Look up a cache entry ({'data', 'etag', 'fresh_until'}), treating Redis errors as a miss"""
+    if cache is None:
+        return None
+    try:
+        cached = cache.get(key)
+    except redis.RedisError as e:
+        logger.warning("Cache lookup failed: %s", e)
+        return None
+    return orjson.loads(cached) if cached is not None else None
+
+
+def cache_set(key: str, ttl: int, data: Optional[Dict], etag: Optional[str] = None):
+    """Store a response in the cache for `ttl` seconds of freshness, ignoring Redis errors"""
+    if cache is None:
+        return
+    entry = {'data': data, 'etag': etag, 'fresh_until': time.time() + ttl}
+    try:
+        cache.setex(key, CACHE_TTL_STALE if data is not None else ttl, orjson.dumps(entry))
+    except redis.RedisError as e:
+        logger.warning("Cache store failed: %s", e)
+
+
+def stale_fallback(entry: Optional[Dict], url: str) -> Optional[Dict]:
+    """Return last-known-good cached data for a failed request, if there is any"""
+    failed_urls = failed_requests.get()
+    if failed_urls is not None:
+        failed_urls.append(url)
+    if entry is None or entry['data'] is None:
+        return None
+    logger.warning("Companies House request failed, serving stale cached data for %s", url)
+    count_cache('stale')
+    job = current_export_job.get()
+    if job is not None:
+        job['stale'] = True
+    return entry['data']
+
+
+def mark_export_incomplete():
+    """Flag the export being run by the current thread as missing data that could not be fetched"""
+    job = current_export_job.get()
+    if job is not None:
+        job['incomplete'] = True
 
 
 def make_api_request(endpoint: str, params: Optional[Dict] = None, method: str = 'GET', json_data: Optional[Dict] = None) -> Optional[Dict]:
@@ -54,56 +261,86 @@ def make_api_request(endpoint: str, params: Optional[Dict] = None, method: str =
     if not API_KEY:
         return None
     
-    check_rate_limit()
+    key = cache_key(endpoint, params, method, json_data)
+    ttl = CACHE_TTL_OFFICERS if '/officers' in endpoint else CACHE_TTL_SEARCH
+    entry = cache_get(key)
+    if entry is not None and entry['fresh_until'] > time.time():
+        count_cache('hits')
+        return entry['data']
+    if cache is not None:
+        count_cache('misses')
+    
+    # Revalidate a stale entry instead of downloading the full response again
+    headers = {'If-None-Match': entry['etag']} if entry is not None and entry['etag'] else None
     
     url = f"{API_BASE_URL}{endpoint}"
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json'
-    }
     
-    try:
-        if method == 'GET':
-            print(f"Making GET request to: {url}")
-            if params:
-                print(f"Query parameters: {params}")
-            response = requests.get(
-                url,
-                auth=(API_KEY, ''),
-                params=params,
-                headers=headers,
-                timeout=30
-            )
-            print(f"Response status: {response.status_code}")
-            if response.status_code != 200:
-                print(f"Response text: {response.text[:500]}")
-        else:
-            # Fallback for other methods if needed
-            response = requests.request(
-                method,
-                url,
-                auth=(API_KEY, ''),
-                params=params,
-                json=json_data,
-                headers=headers,
-                timeout=30
-            )
-        
-        if response.status_code == 429:
-            # Rate limited - wait and retry
-            retry_after = int(response.headers.get('Retry-After', 60))
-            print(f"Rate limited. Waiting {retry_after} seconds...")
-            time.sleep(retry_after)
-            return make_api_request(endpoint, params, method, json_data)
+    for attempt in range(MAX_RETRIES):
+        check_rate_limit()
         
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"API request failed: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Response status: {e.response.status_code}")
-            print(f"Response body: {e.response.text[:200]}")
-        return None
+        try:
+            if method == 'GET':
+                logger.debug("GET %s params=%s", url, params)
+                response = api_session.get(url, params=params, headers=headers, timeout=30)
+                logger.debug("Response status: %d (Content-Encoding: %s)",
+                             response.status_code, response.headers.get('Content-Encoding'))
+            else:
+                # Fallback for other methods if needed
+                response = api_session.request(
+                    method,
+                    url,
+                    params=params,
+                    data=orjson.dumps(json_data) if json_data is not None else None,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=30
+                )
+            
+            if response.status_code == 429:
+                # Rate limited - wait for Retry-After if given, otherwise back off exponentially.
+                # The wait goes through the shared rate limiter, so it is slept once (by the
+                # check_rate_limit() of the next attempt) and holds back the other threads too.
+                retry_after = response.headers.get('Retry-After', '')
+                wait_time = int(retry_after) if retry_after.isdigit() else RETRY_BACKOFF * 2 ** attempt
+                logger.warning("Rate limited by Companies House. Waiting %s seconds...", wait_time)
+                rate_limiter.pause(wait_time)
+                continue
+            
+            if response.status_code == 304 and entry is not None:
+                # Not modified - the cached body is still current
+                count_cache('revalidated')
+                cache_set(key, ttl, entry['data'], entry['etag'])
+                return entry['data']
+            
+            status = response.status_code
+            if 200 <= status < 300:
+                try:
+                    data = orjson.loads(response.content)
+                except orjson.JSONDecodeError as e:
+                    logger.warning("Invalid JSON in HTTP %d response %s: %s", status, endpoint, e)
+                    return stale_fallback(entry, url)
+                cache_set(key, ttl, data, response.headers.get('ETag'))
+                return data
+            
+            if status == 404:
+                logger.debug("HTTP 404 %s", endpoint)
+                cache_set(key, CACHE_TTL_NOT_FOUND, None)
+                return None
+            # Only the start of the error body is decoded for the log
+            logger.warning("HTTP %d %s: %s", status, endpoint, response.content[:500].decode('utf-8', 'replace'))
+            if status >= 500 and attempt + 1 < MAX_RETRIES:
+                # Server error - back off and try again
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+                continue
+            return stale_fallback(entry, url)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            logger.warning("Network error %s: %s", endpoint, e)
+            return stale_fallback(entry, url)
+        except requests.exceptions.RequestException as e:
+            logger.warning("API request failed %s: %s", endpoint, e)
+            return stale_fallback(entry, url)
+    
+    logger.error("Giving up on %s after %d attempts", url, MAX_RETRIES)
+    return stale_fallback(entry, url)
 
 
 def format_address(address: Dict) -> str:
@@ -111,206 +348,231 @@ def format_address(address: Dict) -> str:
     if not address:
         return ''
     
-    parts = []
-    if address.get('address_line_1'):
-        parts.append(address['address_line_1'])
-    if address.get('address_line_2'):
-        parts.append(address['address_line_2'])
-    if address.get('locality'):
-        parts.append(address['locality'])
-    if address.get('region'):
-        parts.append(address['region'])
-    if address.get('postal_code'):
-        parts.append(address['postal_code'])
-    if address.get('country'):
-        parts.append(address['country'])
-    
-    return ', '.join(parts)
+    return join_address_parts(tuple(address.get(field) for field in ADDRESS_FIELDS))
 
 
-def get_company_officers(company_number: str) -> List[Dict]:
-    """Fetch officers (directors) for a company"""
-    officers = []
-    start_index = 0
+@lru_cache(maxsize=4096)
+def join_address_parts(parts: tuple) -> str:
+    """Join the non-empty address parts (cached: the same addresses repeat across many rows)"""
+    return ', '.join(part for part in parts if part)
+
+
+def fetch_company_officers(company_number: str) -> Tuple[List[Dict], bool]:
+    """Fetch officers (directors) for a company from the API; also returns whether every page was fetched"""
+    endpoint = f"/company/{company_number}/officers"
     items_per_page = 100
     
-    while True:
-        endpoint = f"/company/{company_number}/officers"
+    def fetch_page(start_index: int) -> Optional[Dict]:
         params = {
             'items_per_page': items_per_page,
             'start_index': start_index,
             'order_by': 'appointed_on',
             'register_view': 'false'
         }
-        
-        data = make_api_request(endpoint, params)
-        if not data or 'items' not in data:
-            break
-        
-        officers.extend(data['items'])
-        
-        # Check if there are more pages
-        if start_index + items_per_page >= data.get('total_count', 0):
-            break
-        
-        start_index += items_per_page
+        return make_api_request(endpoint, params)
+    
+    # The first page tells us how many officers there are in total
+    data = fetch_page(0)
+    if not data or 'items' not in data:
+        return [], False
+    
+    officers = list(data['items'])
+    
+    # Fetch any remaining pages in parallel, collecting them in appointment order
+    remaining_pages = range(items_per_page, data.get('total_count', 0), items_per_page)
+    if remaining_pages:
+        with ThreadPoolExecutor(max_workers=OFFICER_PAGE_WORKERS) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, fetch_page, start_index)
+                for start_index in remaining_pages
+            ]
+            for future in futures:
+                page = future.result()
+                if not page or 'items' not in page:
+                    return officers, False
+                officers.extend(page['items'])
+    
+    return officers, True
+
+
+def get_company_officers(company_number: str) -> Tuple[Mapping, ...]:
+    """Fetch officers (directors) for a company, from the in-memory cache when possible"""
+    now = time.monotonic()
+    with officers_cache_lock:
+        cached = officers_cache.get(company_number)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    # Collect failed requests for this company's pages (page threads share the list via the context)
+    failed_urls = []
+    context_token = failed_requests.set(failed_urls)
+    try:
+        officers, complete = fetch_company_officers(company_number)
+    finally:
+        failed_requests.reset(context_token)
+    if not complete and failed_urls:
+        # Not a company without officers (404): some of its officers could not be fetched
+        logger.error("Officers for %s are incomplete", company_number)
+        mark_export_incomplete()
+    # Cached results are shared across exports and threads, so they are handed out as a tuple of
+    # read-only views (nested values such as addresses are only ever read)
+    officers = tuple(MappingProxyType(officer) for officer in officers)
+    
+    # Only complete, current results are cached; a failed page must not be remembered as "no officers",
+    # and last-known-good data served during an outage must not be reused as fresh by later exports
+    if complete and not failed_urls:
+        with officers_cache_lock:
+            officers_cache.pop(company_number, None)
+            if len(officers_cache) >= OFFICERS_CACHE_MAXSIZE:
+                # Evict the oldest entry (dicts keep insertion order)
+                del officers_cache[next(iter(officers_cache))]
+            officers_cache[company_number] = (now + OFFICERS_CACHE_TTL, officers)
     
     return officers
 
 
-def search_companies(filters: Dict) -> List[Dict]:
-    """Search for companies using the advanced search API"""
-    companies = []
+def join_sic_codes(sic_codes: str) -> str:
+    """Normalise a comma-separated list of SIC codes, dropping blanks"""
+    return ','.join(code.strip() for code in sic_codes.split(',') if code.strip())
+
+
+# Search form field -> (advanced search query parameter, conversion of the submitted value)
+ADVANCED_SEARCH_PARAMS = {
+    'company_name': ('company_name_includes', str),
+    'company_status': ('company_status', str),
+    'company_type': ('company_type', str),
+    'sic_codes': ('sic_codes', join_sic_codes),
+    'location': ('location', str),
+    'incorporated_from': ('incorporated_from', str),
+    'incorporated_to': ('incorporated_to', str)
+}
+
+
+def iter_companies(filters: Dict, on_total: Optional[Callable[[int], None]] = None) -> Iterator[Dict]:
+    """Search for companies using the advanced search API, yielding them page by page as they arrive"""
+    fetched = 0
     start_index = 0
-    items_per_page = 100
+    total_key = None
+    items_per_page = 100  # /search/companies maximum
     
     # Companies House advanced search API uses GET requests with query parameters
     endpoint = "/advanced-search/companies"
+    page_size = ADVANCED_SEARCH_PAGE_SIZE
     
     # Build query parameters for GET request
-    use_advanced_search = False
     params = {
-        'items_per_page': items_per_page,
+        'size': page_size,
         'start_index': start_index
     }
     
     # Add search filters as query parameters
+    for field, (param, convert) in ADVANCED_SEARCH_PARAMS.items():
+        value = convert(filters[field]) if filters.get(field) else None
+        if value:
+            params[param] = value
+    
+    # A company name on its own does not need advanced search: name-only queries go
+    # straight to the simpler /search/companies endpoint below
+    use_advanced_search = any(
+        param in params for param, _ in ADVANCED_SEARCH_PARAMS.values() if param != 'company_name_includes'
+    )
+    
+    # Regular search endpoint, usable whenever a company name was given
+    name_search_params = None
     if filters.get('company_name'):
-        params['company_name_includes'] = filters['company_name']
-        use_advanced_search = True
-    if filters.get('company_status'):
-        params['company_status'] = filters['company_status']
-        use_advanced_search = True
-    if filters.get('company_type'):
-        params['company_type'] = filters['company_type']
-        use_advanced_search = True
-    if filters.get('sic_codes'):
-        sic_list = [code.strip() for code in filters['sic_codes'].split(',') if code.strip()]
-        if sic_list:
-            # For GET requests, pass SIC codes as comma-separated string or multiple params
-            params['sic_codes'] = ','.join(sic_list)
-            use_advanced_search = True
-    if filters.get('location'):
-        params['location'] = filters['location']
-        use_advanced_search = True
-    if filters.get('incorporated_from'):
-        params['incorporated_from'] = filters['incorporated_from']
-        use_advanced_search = True
-    if filters.get('incorporated_to'):
-        params['incorporated_to'] = filters['incorporated_to']
-        use_advanced_search = True
+        name_search_params = {
+            'q': filters['company_name'],
+            'items_per_page': items_per_page,
+            'start_index': start_index
+        }
     
-    while True:
-        if use_advanced_search:
-            # GET request for advanced search
-            params['start_index'] = start_index
-            print(f"GET request URL: {API_BASE_URL}{endpoint}")
-            print(f"GET request params: {params}")
-            data = make_api_request(endpoint, params, method='GET')
-        elif filters.get('company_name'):
-            # Use regular search endpoint for simple name-only searches
-            endpoint = "/search/companies"
-            params = {
-                'q': filters['company_name'],
-                'items_per_page': items_per_page,
-                'start_index': start_index
-            }
-            data = make_api_request(endpoint, params)
-        else:
+    # Pick the endpoint once so every page of a search goes to the same place
+    if not use_advanced_search:
+        if not name_search_params:
             # No valid filters
-            break
+            return
+        endpoint = "/search/companies"
+        params = name_search_params
+        page_size = items_per_page
+    
+    while True:
+        params['start_index'] = start_index
+        logger.debug("Search request %s params=%s", endpoint, params)
+        data = make_api_request(endpoint, params)
         
-        # If advanced search fails, return empty list
-        if not data and use_advanced_search:
-            print("\n❌ ERROR: Advanced search request failed.")
-            return []  # Return empty list so user sees error message
+        if not data and endpoint == "/advanced-search/companies" and start_index == 0 and name_search_params:
+            # Advanced search is unavailable - fall back once to the regular name search
+            logger.warning("Advanced search request failed. Falling back to /search/companies.")
+            endpoint = "/search/companies"
+            params = name_search_params
+            page_size = items_per_page
+            continue
         
         if not data or 'items' not in data:
+            if start_index > 0:
+                # A later page failed: the companies already fetched are kept, but the export is flagged
+                logger.error("Search request failed at start_index=%d; results are incomplete", start_index)
+                mark_export_incomplete()
+            elif not data:
+                # With nothing found yet the user sees an error message
+                logger.error("Search request failed.")
             break
         
-        # Add companies from this page
-        page_items = data.get('items', [])
-        companies.extend(page_items)
-        
-        print(f"Fetched page: {len(page_items)} companies (start_index={start_index}, total so far: {len(companies)})")
+        # Companies House API uses different field names in different endpoints; an endpoint
+        # always uses the same one, so it is looked up on the first page only
+        first_page = total_key is None
+        if first_page:
+            total_key = next((k for k in TOTAL_RESULTS_KEYS if k in data), '')
+        total_results = data.get(total_key, 0) if total_key else 0
+        if first_page and on_total:
+            on_total(total_results)
         
-        # Check if there are more pages
-        # Companies House API uses different field names in different endpoints
-        total_results = data.get('total_results', 0) or data.get('total_count', 0) or data.get('total_items', 0)
+        # Hand this page's companies to the caller before requesting the next page
+        page_items = data.get('items', [])
+        fetched += len(page_items)
+        logger.debug("Fetched page: %d companies (start_index=%d, total so far: %d)",
+                     len(page_items), start_index, fetched)
+        yield from page_items
         
-        # Check if we've fetched all results
+        # Check if we've fetched all results, without probing for an empty page after the last one
         if total_results > 0:
-            print(f"Total results available: {total_results}")
             if start_index + len(page_items) >= total_results:
-                print(f"All results fetched. Total: {len(companies)}")
+                logger.info("All results fetched. Total: %d of %d", fetched, total_results)
                 break
-        elif len(page_items) < items_per_page:
+        elif len(page_items) < page_size:
             # If we got fewer items than requested, we're on the last page
-            print(f"Last page reached (got {len(page_items)} items). Total: {len(companies)}")
+            logger.info("Last page reached (got %d items). Total: %d", len(page_items), fetched)
             break
         
-        start_index += items_per_page
-    
-    return companies
-
-
-@app.route('/')
-def index():
-    """Render the main search page"""
-    return render_template('index.html')
+        if not page_items:
+            break
+        
+        # Advance by what was actually returned, in case the API used a smaller page than requested
+        start_index += len(page_items)
 
 
-@app.route('/search', methods=['POST'])
-def search():
-    """Handle company search and generate CSV"""
-    try:
-        # Get filters from form
-        filters = {
-            'company_name': request.form.get('company_name', '').strip(),
-            'company_status': request.form.get('company_status', '').strip() or None,
-            'company_type': request.form.get('company_type', '').strip() or None,
-            'sic_codes': request.form.get('sic_codes', '').strip() or None,
-            'location': request.form.get('location', '').strip() or None,
-            'incorporated_from': request.form.get('incorporated_from', '').strip() or None,
-            'incorporated_to': request.form.get('incorporated_to', '').strip() or None,
-        }
-        
-        # Remove None values
-        filters = {k: v for k, v in filters.items() if v}
-        
-        if not filters:
-            return jsonify({'error': 'Please provide at least one search filter'}), 400
-        
-        # Search for companies
-        print(f"Searching with filters: {filters}")
-        companies = search_companies(filters)
-        print(f"Found {len(companies)} companies total")
-        
-        if not companies:
-            error_msg = 'No companies found matching your criteria.'
-            # Check if advanced search was attempted
-            if any(filters.get(k) for k in ['sic_codes', 'incorporated_from', 'incorporated_to', 'company_status', 'company_type']):
-                error_msg += '\n\n⚠️ IMPORTANT: The Companies House public API does not support advanced search.\n'
-                error_msg += 'The /advanced-search/companies endpoint returns "405 Method Not Allowed".'
-            return jsonify({'error': error_msg}), 404
-        
-        # Create CSV in memory
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header - matching Companies House format with director info added
-        writer.writerow([
-            'company_name',
-            'company_number',
-            'company_status',
-            'company_type',
-            'company_subtype',
-            'dissolution_date',
-            'incorporation_date',
-            'removed_date',
-            'registered_date',
-            'nature_of_business',
-            'registered_office_address',
+def generate_csv(companies: Iterable[Dict], include_officers: bool = True,
+                 on_progress: Optional[Callable[[int], None]] = None):
+    """Yield the CSV export for the given companies in chunks of whole rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    
+    # Write header - matching Companies House format with director info added
+    header = [
+        'company_name',
+        'company_number',
+        'company_status',
+        'company_type',
+        'company_subtype',
+        'dissolution_date',
+        'incorporation_date',
+        'removed_date',
+        'registered_date',
+        'nature_of_business',
+        'registered_office_address'
+    ]
+    if include_officers:
+        header += [
             'director_name',
             'director_address',
             'director_nationality',
@@ -318,11 +580,43 @@ def search():
             'director_role',
             'director_appointed_date',
             'director_resigned_date'
-        ])
+        ]
+    writer.writerow(header)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    
+    # Filter: Only include ACTIVE companies (case-insensitive)
+    # Skip companies that are not explicitly ACTIVE (including empty status)
+    active_companies = (
+        company for company in companies
+        if (company.get('company_status', '') or company.get('status', '')).strip().upper() == 'ACTIVE'
+    )
+    
+    # Fetch officers concurrently for up to OFFICER_PREFETCH companies ahead of the one being written.
+    # Companies are pulled from the search as the window drains, so officer lookups overlap with
+    # fetching the next page of search results. Company-only exports skip officer requests entirely.
+    with ThreadPoolExecutor(max_workers=OFFICER_FETCH_WORKERS) as executor:
+        pending = deque()
         
-        # Process each company
-        total_companies = len(companies)
-        for idx, company in enumerate(companies):
+        def schedule(count: int):
+            for company in islice(active_companies, count):
+                future = None
+                if include_officers:
+                    future = executor.submit(contextvars.copy_context().run,
+                                             get_company_officers, company.get('company_number', ''))
+                pending.append((company, future))
+        
+        schedule(OFFICER_PREFETCH)
+        
+        # Process each company, in search order
+        processed = 0
+        while pending:
+            company, future = pending.popleft()
+            schedule(1)
+            officers = future.result() if future else None
+            processed += 1
+            
             company_number = company.get('company_number', '')
             # Try multiple possible field names for company name
             company_name = (company.get('company_name') or 
@@ -338,11 +632,6 @@ def search():
             removed_date = company.get('removed_date', '')
             registered_date = company.get('registered_date', '')
             
-            # Filter: Only include ACTIVE companies (case-insensitive)
-            # Skip companies that are not explicitly ACTIVE (including empty status)
-            if not company_status or company_status.upper() != 'ACTIVE':
-                continue  # Skip non-active companies
-            
             # Get SIC codes - can be in different formats
             sic_codes_list = company.get('sic_codes', [])
             if isinstance(sic_codes_list, list):
@@ -350,101 +639,280 @@ def search():
             else:
                 nature_of_business = str(sic_codes_list) if sic_codes_list else ''
             
-            registered_address = format_address(company.get('registered_office_address', {}))
+            # /search/companies results carry the registered office as 'address'
+            registered_address = format_address(company.get('registered_office_address') or company.get('address', {}))
             
-            # Fetch officers for this company
-            officers = get_company_officers(company_number)
+            # Company columns are the same on every row written for this company
+            company_row = (
+                company_name,
+                company_number,
+                company_status,
+                company_type,
+                company_subtype,
+                dissolution_date,
+                incorporation_date,
+                removed_date,
+                registered_date,
+                nature_of_business,
+                registered_address
+            )
             
-            if not officers:
-                # Write company row even if no officers found
-                writer.writerow([
-                    company_name,
-                    company_number,
-                    company_status,
-                    company_type,
-                    company_subtype,
-                    dissolution_date,
-                    incorporation_date,
-                    removed_date,
-                    registered_date,
-                    nature_of_business,
-                    registered_address,
-                    '',  # Director Name
-                    '',  # Director Address
-                    '',  # Director Nationality
-                    '',  # Director Occupation
-                    '',  # Director Role
-                    '',  # Director Appointed Date
-                    ''   # Director Resigned Date
-                ])
+            if not include_officers:
+                writer.writerow(company_row)
+            elif not officers:
+                # Write company row even if no officers found (empty director columns)
+                writer.writerow(company_row + ('',) * 7)
             else:
                 # Write a row for each director
-                for officer in officers:
-                    officer_name = officer.get('name', '')
-                    officer_address = format_address(officer.get('address', {}))
-                    officer_nationality = officer.get('nationality', '')
-                    officer_occupation = officer.get('occupation', '')
-                    officer_role = officer.get('officer_role', '')
-                    officer_appointed = officer.get('appointed_on', '')
-                    officer_resigned = officer.get('resigned_on', '')
-                    
-                    writer.writerow([
-                        company_name,
-                        company_number,
-                        company_status,
-                        company_type,
-                        company_subtype,
-                        dissolution_date,
-                        incorporation_date,
-                        removed_date,
-                        registered_date,
-                        nature_of_business,
-                        registered_address,
-                        officer_name,
-                        officer_address,
-                        officer_nationality,
-                        officer_occupation,
-                        officer_role,
-                        officer_appointed,
-                        officer_resigned
-                    ])
+                writer.writerows(
+                    company_row + (
+                        officer.get('name', ''),
+                        format_address(officer.get('address', {})),
+                        officer.get('nationality', ''),
+                        officer.get('occupation', ''),
+                        officer.get('officer_role', ''),
+                        officer.get('appointed_on', ''),
+                        officer.get('resigned_on', '')
+                    )
+                    for officer in officers
+                )
             
             # Log progress
-            if (idx + 1) % 10 == 0:
-                print(f"Processed {idx + 1}/{total_companies} companies...")
+            if processed % 10 == 0 or not pending:
+                logger.debug("Processed %d companies...", processed)
+                if on_progress:
+                    on_progress(processed)
+            
+            # Send rows in chunks of about CSV_CHUNK_SIZE and reuse the buffer for the next chunk
+            if buffer.tell() >= CSV_CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_job_path(job_id: str, extension: str) -> str:
+    """Path of a job's state (.json) or CSV (.csv) file"""
+    return os.path.join(EXPORT_DIR, f"{job_id}.{extension}")
+
+
+def load_export_job(job_id: str) -> Optional[Dict]:
+    """Read a job's state, or None if the id is malformed or unknown"""
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    try:
+        with open(export_job_path(job_id, 'json'), 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def save_export_job(job: Dict):
+    """Write a job's state atomically so readers never see a partial file"""
+    path = export_job_path(job['id'], 'json')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(orjson.dumps(job))
+    os.replace(path + '.tmp', path)
+
+
+def remove_expired_export_jobs():
+    """Delete state and CSV files of jobs that ended more than EXPORT_JOB_TTL ago"""
+    now = time.time()
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        job_id = name.split('.')[0]
+        try:
+            age = now - os.path.getmtime(path)
+            if age < EXPORT_JOB_TTL:
+                continue
+            if name.endswith('.json'):
+                # Queued jobs are not rewritten until they start, so only ended jobs expire
+                # (and jobs orphaned by a restart, once they are clearly abandoned)
+                try:
+                    job = load_export_job(job_id)
+                except ValueError:
+                    job = None
+                if job and job['status'] not in EXPORT_JOB_ENDED and age < EXPORT_JOB_ORPHAN_TTL:
+                    continue
+                os.remove(path)
+                path = export_job_path(job_id, 'csv')
+            elif os.path.exists(export_job_path(job_id, 'json')):
+                continue  # Removed together with the job's state
+            os.remove(path)
+        except OSError:
+            pass  # Removed by another worker in the meantime
+
+
+def run_export(job: Dict, filters: Dict, include_officers: bool = True, confirm_large_export: bool = False):
+    """Search for companies and write the CSV export for a background job"""
+    # Reset afterwards: pool threads keep their context from one job to the next
+    context_token = current_export_job.set(job)
+    try:
+        job['status'] = 'running'
+        save_export_job(job)
+        
+        # Search for companies; pages keep arriving while the CSV is being written
+        logger.info("Export %s searching with filters: %s", job['id'], filters)
+        search_total = []
+        companies = iter_companies(filters, search_total.append)
+        first_company = next(companies, None)
+        
+        if first_company is None:
+            error_msg = 'No companies found matching your criteria.'
+            # Check if advanced search was attempted
+            if any(filters.get(k) for k in ['sic_codes', 'incorporated_from', 'incorporated_to', 'company_status', 'company_type']):
+                error_msg += '\n\n⚠️ IMPORTANT: The Companies House public API does not support advanced search.\n'
+                error_msg += 'The /advanced-search/companies endpoint returns "405 Method Not Allowed".'
+            job['status'] = 'failed'
+            job['error'] = error_msg
+            save_export_job(job)
+            return
         
-        # Prepare CSV for download
-        output.seek(0)
-        csv_content = output.getvalue()
-        output.close()
+        # Directors cost at least one extra request per company, so very large searches need
+        # explicit confirmation before they are fetched (the total includes inactive companies)
+        total_results = search_total[0] if search_total else 0
+        if include_officers and not confirm_large_export and total_results > LARGE_OFFICER_EXPORT:
+            job['status'] = 'confirmation_required'
+            job['error'] = (f'This search matched {total_results} companies. Including director details '
+                            f'needs an extra API request for each one and may take a long time. '
+                            f'Confirm the export or untick "Include director details".')
+            save_export_job(job)
+            return
         
-        # Create BytesIO for file download
-        csv_bytes = io.BytesIO()
-        csv_bytes.write(csv_content.encode('utf-8'))
-        csv_bytes.seek(0)
+        def on_progress(processed: int):
+            job['progress'] = {'processed': processed}
+            save_export_job(job)
         
-        filename = f"companies_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        with open(export_job_path(job['id'], 'csv'), 'w', encoding='utf-8', newline='') as f:
+            for chunk in generate_csv(chain([first_company], companies), include_officers, on_progress):
+                f.write(chunk)
         
-        return send_file(
-            csv_bytes,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=filename
-        )
+        # job['stale'] is set by stale_fallback if last-known-good data was served during an API outage
+        job['status'] = 'finished'
+        save_export_job(job)
         
     except Exception as e:
-        print(f"Error during search: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error during export %s", job['id'])
+        job['status'] = 'failed'
+        job['error'] = f'An error occurred: {str(e)}'
+        save_export_job(job)
+    finally:
+        current_export_job.reset(context_token)
+
+
+@app.route('/')
+def index():
+    """Render the main search page"""
+    return render_template('index.html')
+
+
+@app.route('/search', methods=['POST'])
+def search():
+    """Start a company search and CSV export as a background job"""
+    try:
+        # Get filters from form
+        filters = {
+            'company_name': request.form.get('company_name', '').strip(),
+            'company_status': request.form.get('company_status', '').strip() or None,
+            'company_type': request.form.get('company_type', '').strip() or None,
+            'sic_codes': request.form.get('sic_codes', '').strip() or None,
+            'location': request.form.get('location', '').strip() or None,
+            'incorporated_from': request.form.get('incorporated_from', '').strip() or None,
+            'incorporated_to': request.form.get('incorporated_to', '').strip() or None,
+        }
+        
+        # Remove None values
+        filters = {k: v for k, v in filters.items() if v}
+        
+        if not filters:
+            return jsonify({'error': 'Please provide at least one search filter'}), 400
+        
+        # Director columns need one extra API call per company, so they can be turned off
+        include_officers = request.form.get('include_officers', 'true').strip().lower() == 'true'
+        confirm_large_export = request.form.get('confirm_large_export', '').strip().lower() == 'true'
+        
+        remove_expired_export_jobs()
+        
+        # Run the export in the background; the client polls /search/<job_id> for progress
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'progress': None,
+            'error': None,
+            'stale': False,
+            'incomplete': False,
+            'filename': f"companies_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        }
+        save_export_job(job)
+        # The worker gets its own copy, so this response reports the job as it was queued
+        export_executor.submit(run_export, dict(job), filters, include_officers, confirm_large_export)
+        
+        return jsonify({
+            'job_id': job['id'],
+            'status': job['status'],
+            'status_url': f"/search/{job['id']}",
+            'download_url': f"/search/{job['id']}/download"
+        }), 202
+        
+    except Exception as e:
+        logger.exception("Error during search")
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
 
 
+@app.route('/search/<job_id>')
+def search_status(job_id: str):
+    """Report the status and progress of a background export"""
+    job = load_export_job(job_id)
+    if not job:
+        return jsonify({'error': 'Export not found'}), 404
+    
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'error': job['error'],
+        'stale': job['stale'],
+        'incomplete': job.get('incomplete', False)
+    })
+
+
+@app.route('/search/<job_id>/download')
+def search_download(job_id: str):
+    """Download the CSV of a finished export"""
+    job = load_export_job(job_id)
+    if not job:
+        return jsonify({'error': 'Export not found'}), 404
+    if job['status'] != 'finished':
+        return jsonify({'error': f"Export is not ready (status: {job['status']})"}), 409
+    
+    response = send_file(
+        export_job_path(job_id, 'csv'),
+        mimetype='text/csv',
+        as_attachment=True,
+        download_name=job['filename']
+    )
+    if job['stale']:
+        response.headers['X-Cache'] = 'stale'
+    if job.get('incomplete'):
+        response.headers['X-Export-Incomplete'] = 'true'
+    return response
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
     return jsonify({
         'status': 'ok',
-        'api_key_configured': bool(API_KEY)
+        'api_key_configured': bool(API_KEY),
+        'cache': {
+            'enabled': cache is not None,
+            'hits': cache_stats['hits'],
+            'misses': cache_stats['misses'],
+            'revalidated': cache_stats['revalidated'],
+            'stale': cache_stats['stale']
+        }
     })
 
 
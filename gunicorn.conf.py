@@ -0,0 +1,12 @@
+# Gunicorn configuration, picked up automatically by `gunicorn app:app`
+# gevent workers multiplex many in-flight Companies House requests per process
+# (gunicorn monkey-patches the standard library before loading the app)
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = 'gevent'
+# One process by default: the rate limiter and officer cache live in process memory, so extra
+# processes split the API budget between them (app.py divides it by WEB_CONCURRENCY).
+# Scale concurrent requests with worker_connections instead.
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+worker_connections = 100